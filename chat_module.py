@@ -1,22 +1,86 @@
+import asyncio
+import functools
+import hashlib
+import json
 import os
-from traceback import format_exc
-from typing import Callable, Dict, List, Literal, Type
+import re
+import string
+from collections import Counter
+from datetime import timedelta
+from typing import AsyncIterator, Callable, Dict, List, Literal, Optional, Tuple, Type
 
+import httpx
 import instructor
 import openai
 from dotenv import load_dotenv
 from loguru import logger
 from pydantic import BaseModel, Field
 from telegram import Update
+from telegram.constants import ChatType
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import ContextTypes
 
+from database import Database
+from semantic_cache import DEFAULT_SIMILARITY_THRESHOLD, SemanticCache
+
 load_dotenv()
 
-client = openai.AsyncClient(api_key=os.getenv("OPENAI_API_KEY"), base_url=os.getenv("OPENAI_BASE_URL"))
+MODEL = "gpt-4o"
+DEFAULT_MAX_TURNS = 20
+STREAM_EDIT_INTERVAL = 0.3
+# Telegram allows about 20 messages per minute in a group, edits included
+GROUP_STREAM_EDIT_INTERVAL = 3.0
+MAX_VALIDATION_RETRIES = 2
+HISTORY_SEP = "-" * 30
+DEFAULT_PROMPT = 'Be a helpful assistant with the query, {chat_history}'
+
+# Messages answered from templates without calling the model, see prefilter_reply
+TRIVIAL_MESSAGE_PATTERN = re.compile(r'^(/start|/help|hi|hello|hey|thanks|thank you|ok|👍|👋)$')
+# Short messages without any letters, digits or CJK characters, e.g. "?" or a lone emoji
+SHORT_SYMBOLS_PATTERN = re.compile(r'^\W{1,2}$')
+DEFAULT_QUICK_REPLIES = {
+    '/start': 'Hi, I am {name}',
+    '/help': 'Just send me a message and I will do my best to help.',
+    'hi': 'Hi! How can I help you?',
+    'hello': 'Hello! How can I help you?',
+    'hey': 'Hey! How can I help you?',
+    'thanks': "You're welcome!",
+    'thank you': "You're welcome!",
+    'ok': '👍',
+    '👍': '😊',
+    '👋': '👋',
+    'symbols': '🙂',
+}
+SUMMARY_PROMPT = """Summarize the conversation below between a user and {bot_name}. Keep facts, user needs and \
+commitments that matter for continuing the conversation.
+
+Previous summary:
+{summary}
+
+Conversation:
+{chat_history}"""
+
+client = openai.AsyncClient(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    base_url=os.getenv("OPENAI_BASE_URL"),
+    # Keep warm connections around across bursts; HTTP/2 multiplexes concurrent completions on them
+    http_client=openai.DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=60.0),
+        timeout=httpx.Timeout(60.0, connect=5.0))
+)
 istr_client = instructor.from_openai(client)
 
 logger.info("OpenAI client initialized with base URL: {}", os.getenv("OPENAI_BASE_URL"))
 
+semantic_cache = SemanticCache()
+
+# Strong references to fire-and-forget tasks, and chats currently being summarized
+_background_tasks = set()
+_summarizing = set()
+# How often each quick reply was served, to tune the prefilter
+prefilter_hits = Counter()
+
 
 class ProductSearchQuery(BaseModel):
     query: str = Field(..., title="A fully contextualized product search query sentence")
@@ -42,97 +106,526 @@ class ReplyAction(Action):
     action_input: Reply
 
 
+class ChatSummary(BaseModel):
+    summary: str
+
+
+PRODUCT_SEARCH_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "product_search",
+        "description": "Search the product catalog",
+        "parameters": ProductSearchQuery.model_json_schema(),
+    },
+}
+
+
+class StreamedReply(str):
+    """A reply already delivered to the user by streaming; callers should record it but not send it again."""
+
+
+@functools.lru_cache(maxsize=None)
+def get_schema_json(response_model: Type[BaseModel]) -> str:
+    """JSON schema of a response model, generated and serialized once per class."""
+    return json.dumps(response_model.model_json_schema(), sort_keys=True)
+
+
+@functools.lru_cache(maxsize=None)
+def get_instructor_model(response_model: Type[BaseModel]) -> Type[BaseModel]:
+    """
+    The instructor function-calling wrapper of a response model, built once per class.
+
+    instructor only wraps models that are not already OpenAISchema subclasses, so passing this skips it
+    creating a new model class and schema on every call.
+    """
+    return instructor.openai_schema(response_model)
+
+
+def get_llm_cache_key(messages: List[Dict], response_model: Type[BaseModel]) -> str:
+    payload = {"model": MODEL, "messages": messages, "schema": get_schema_json(response_model)}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def cached_llm(fn: Callable) -> Callable:
+    """
+    Short-circuit a completion call with an exact-match lookup in the database's llm_cache table.
+
+    The wrapped coroutine gets an extra `cache` keyword; caching is skipped when it is None.
+    """
+
+    @functools.wraps(fn)
+    async def wrapper(messages: List[Dict], response_model: Type[BaseModel], cache: Optional[Database] = None):
+        if cache is None:
+            return await fn(messages, response_model)
+
+        key = get_llm_cache_key(messages, response_model)
+        cached = await asyncio.to_thread(cache.get_llm_cache, key)
+        if cached is not None:
+            logger.debug("LLM cache hit for key {}", key)
+            return response_model.model_validate_json(cached)
+
+        result = await fn(messages, response_model)
+        await asyncio.to_thread(cache.set_llm_cache, key, result.model_dump_json())
+        return result
+
+    return wrapper
+
+
+@cached_llm
+async def create_completion(messages: List[Dict], response_model: Type[BaseModel]) -> BaseModel:
+    result, completion = await istr_client.chat.completions.create_with_completion(
+        model=MODEL,
+        messages=messages,
+        response_model=get_instructor_model(response_model),
+        max_retries=MAX_VALIDATION_RETRIES
+    )
+    usage = completion.usage
+    if usage and usage.prompt_tokens_details:
+        logger.debug("Prompt tokens: {}, cached: {}",
+                     usage.prompt_tokens, usage.prompt_tokens_details.cached_tokens)
+    return result
+
+
+def split_prompt(prompt: str) -> Tuple[str, str]:
+    """
+    Split a prompt template at its first placeholder.
+
+    Returns the static preamble (with escaped braces resolved) and the remaining template. Sending the preamble
+    as its own leading message keeps the request prefix identical across calls, so OpenAI prompt caching applies.
+    """
+    i = 0
+    while i < len(prompt):
+        if prompt[i] in '{}' and prompt[i + 1:i + 2] == prompt[i]:
+            i += 2
+        elif prompt[i] == '{':
+            break
+        else:
+            i += 1
+    return prompt[:i].format(), prompt[i:]
+
+
 def get_chat_history_as_str(
         bot_name: str,
         chat_histories: List[Dict],
-        last_user_msg: str = None
+        last_user_msg: str = None,
+        max_turns: int = DEFAULT_MAX_TURNS,
+        summary: str = None
 ) -> str:
-    if not chat_histories:
+    """Format the last `max_turns` messages of a chat for the prompt, after the rolling summary if any."""
+    if not chat_histories and not summary:
         return f"No messages found between user and {bot_name}"
 
     result = []
-    for msg in chat_histories:
+    if summary:
+        result.append(f"Summary of earlier conversation: {summary}")
+        result.append(HISTORY_SEP)
+    for msg in chat_histories[-max_turns:]:
         sender = bot_name if msg['is_from_bot'] else "User"
         result.append(f"{sender}: {msg['message']}")
         result.append(f"Time: {msg['timestamp']}")
-        result.append("-" * 30)
+        result.append(HISTORY_SEP)
     if last_user_msg:
         result.append(f"User: {last_user_msg}")
         result.append(f"Time: Just now")
-        result.append("-" * 30)
+        result.append(HISTORY_SEP)
     return "\n".join(result)
 
 
-async def act(
-        prompt: str,
+async def summarize_chat(db: Database, chat_id: str, bot_id: str, bot_name: str, max_turns: int):
+    """
+    Fold the messages older than the last `max_turns` into the chat's rolling summary.
+
+    A pass folds at most 2 * max_turns messages, so a long backlog is caught up over several passes instead of
+    one oversized prompt.
+    """
+    key = (bot_id, chat_id)
+    if key in _summarizing:
+        return
+    _summarizing.add(key)
+    try:
+        chat_summary = await asyncio.to_thread(db.get_chat_summary, chat_id, bot_id)
+        last_message_id = chat_summary['last_message_id'] if chat_summary else 0
+        messages = await asyncio.to_thread(
+            db.get_messages_to_summarize, chat_id, bot_id, last_message_id, max_turns, 2 * max_turns)
+        if not messages:
+            return
+
+        logger.info("Summarizing {} messages of chat {} for bot {}", len(messages), chat_id, bot_id)
+        content = SUMMARY_PROMPT.format(
+            bot_name=bot_name,
+            summary=chat_summary['summary'] if chat_summary else 'N/A',
+            chat_history=get_chat_history_as_str(bot_name, messages, max_turns=len(messages)))
+        result = await create_completion([{"role": "user", "content": content}], ChatSummary)
+        await asyncio.to_thread(db.set_chat_summary, chat_id, bot_id, result.summary, messages[-1]['message_id'])
+    except Exception as e:
+        logger.exception("Error summarizing chat {} for bot {}: {}", chat_id, bot_id, e)
+    finally:
+        _summarizing.discard(key)
+
+
+async def get_chat_summary(db: Database, chat_id: str, bot_id: str, config: Dict) -> Optional[str]:
+    """Return the chat's rolling summary, starting a background refresh when too many messages are uncovered."""
+    max_turns = config.get('max_turns', DEFAULT_MAX_TURNS)
+    # One round trip, counting only as far as needed to decide on a refresh
+    chat_summary, backlog = await asyncio.to_thread(db.get_chat_summary_backlog, chat_id, bot_id, 2 * max_turns + 1)
+    if backlog > 2 * max_turns:
+        task = asyncio.create_task(summarize_chat(db, chat_id, bot_id, config['name'], max_turns))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    return chat_summary['summary'] if chat_summary else None
+
+
+class PromptTemplate:
+    """
+    A prompt template parsed once, so rendering it only stringifies the placeholder values.
+
+    The static preamble before the first placeholder is kept separately, see split_prompt.
+    """
+
+    _formatter = string.Formatter()
+
+    def __init__(self, template: str):
+        self.template = template
+        self.preamble, rest = split_prompt(template)
+        self._parts = list(self._formatter.parse(rest))
+
+    def format(self, **fields) -> str:
+        """Render the part after the preamble, like `str.format` does."""
+        result = []
+        for literal_text, field_name, format_spec, conversion in self._parts:
+            result.append(literal_text)
+            if field_name is None:
+                continue
+            value = self._formatter.get_field(field_name, (), fields)[0]
+            if conversion:
+                value = self._formatter.convert_field(value, conversion)
+            result.append(format(value, format_spec) if format_spec else str(value))
+        return "".join(result)
+
+
+def build_act_messages(
+        prompt: PromptTemplate | str,
         chat_history_str: str,
-        product_search_result: ProductSearchResult = None,
-        action_type: Type[BaseModel] = Action
-) -> Action | ReplyAction:
+        product_search_result: ProductSearchResult = None
+) -> List[Dict]:
+    if isinstance(prompt, str):
+        prompt = PromptTemplate(prompt)
     content = prompt.format(
         chat_history=chat_history_str,
         product_search_result=product_search_result.answer if product_search_result else 'N/A')
+    logger.opt(lazy=True).debug(
+        "Generating action with prompt: {}", lambda: content[:100] + "..." if len(content) > 100 else content)
+    if prompt.preamble and content:
+        return [{"role": "system", "content": prompt.preamble}, {"role": "user", "content": content}]
+    return [{"role": "user", "content": prompt.preamble + content}]
+
 
-    logger.debug("Generating action with prompt: {}", content[:100] + "..." if len(content) > 100 else content)
+async def act(
+        prompt: PromptTemplate | str,
+        chat_history_str: str,
+        product_search_result: ProductSearchResult = None,
+        action_type: Type[BaseModel] = Action,
+        cache: Optional[Database] = None
+) -> Action | ReplyAction:
+    messages = build_act_messages(prompt, chat_history_str, product_search_result)
     try:
-        action = await istr_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": content}],
-            response_model=action_type
-        )
-        logger.debug(f"Generated action: {action}")
+        action = await create_completion(messages, action_type, cache=cache)
+        logger.debug("Generated action: {}", action)
         return action
     except Exception as e:
-        logger.exception(f"Error generating action: {str(e)}, {format_exc()}")
+        logger.exception("Error generating action: {}", e)
         raise e
 
 
-async def product_search(product_catalog: str, query: str) -> ProductSearchResult:
+async def stream_to_chat(
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        texts: AsyncIterator[str]
+) -> "StreamedReply":
+    """
+    Send a reply to the user while it is generated.
+
+    `texts` yields the reply text so far. The message is sent as soon as it is non-empty and then edited at most
+    every STREAM_EDIT_INTERVAL seconds (GROUP_STREAM_EDIT_INTERVAL in groups), to stay within Telegram's rate
+    limits. A failed update is skipped, and once the message is sent errors never replace it; the returned reply
+    is the text the user sees.
+    """
+    loop = asyncio.get_running_loop()
+    interval = STREAM_EDIT_INTERVAL if update.message.chat.type == ChatType.PRIVATE else GROUP_STREAM_EDIT_INTERVAL
+    sent_message = None
+    sent_text = text = ""
+    next_edit = 0.0
+
+    async def show(new_text: str):
+        nonlocal sent_message, sent_text, next_edit
+        next_edit = loop.time() + interval
+        try:
+            if sent_message is None:
+                sent_message = await update.message.reply_text(new_text)
+            else:
+                await context.bot.edit_message_text(
+                    new_text, chat_id=sent_message.chat_id, message_id=sent_message.message_id)
+            sent_text = new_text
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            next_edit = loop.time() + (retry_after.total_seconds() if isinstance(retry_after, timedelta)
+                                       else retry_after)
+            logger.warning("Rate limited while streaming a reply, waiting {}s", retry_after)
+        except BadRequest as e:
+            if "not modified" in str(e):
+                # Telegram trims whitespace, so the message already shows this text
+                sent_text = new_text
+            else:
+                logger.warning("Skipping streamed reply update: {}", e)
+        except TelegramError as e:
+            logger.warning("Skipping streamed reply update: {}", e)
+
+    try:
+        async for text in texts:
+            if text and text != sent_text and loop.time() >= next_edit:
+                await show(text)
+    except Exception as e:
+        if sent_message is None:
+            raise
+        logger.exception("Error generating streamed reply, keeping what was sent: {}", e)
+
+    # Show the final text, waiting out the edit interval or a rate limit once more if needed
+    for _ in range(2):
+        if not text or text == sent_text:
+            break
+        await asyncio.sleep(max(next_edit - loop.time(), 0))
+        await show(text)
+
+    if sent_message is None:
+        raise RuntimeError("Streamed reply could not be sent")
+    logger.debug("Streamed reply: {}", sent_text)
+    return StreamedReply(sent_text)
+
+
+async def stream_act(
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        prompt: PromptTemplate | str,
+        chat_history_str: str,
+        product_search_result: ProductSearchResult = None
+) -> "StreamedReply":
+    """Generate the final ReplyAction while streaming its message to the user."""
+    messages = build_act_messages(prompt, chat_history_str, product_search_result)
+
+    async def texts():
+        text = ""
+        async for partial in istr_client.chat.completions.create_partial(
+                model=MODEL,
+                messages=messages,
+                response_model=ReplyAction
+        ):
+            text = (partial.action_input and partial.action_input.message) or text
+            yield text
+
+    try:
+        return await stream_to_chat(update, context, texts())
+    except Exception as e:
+        logger.exception("Error streaming reply: {}", e)
+        raise e
+
+
+async def act_with_tools(
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        prompt: PromptTemplate | str,
+        chat_history_str: str,
+        config: Dict,
+        cache: Optional[Database] = None
+) -> str:
+    """
+    Reply in one model pass, letting the model call product_search as a native tool when it needs to.
+
+    Only when a search is requested are the tool results appended and a second pass made for the final reply,
+    streamed to the user if the bot has "stream_reply" enabled.
+    """
+    messages = build_act_messages(prompt, chat_history_str)
+    try:
+        completion = await client.chat.completions.create(model=MODEL, messages=messages, tools=[PRODUCT_SEARCH_TOOL])
+        choice = completion.choices[0]
+        if not choice.message.tool_calls:
+            return choice.message.content or ""
+
+        messages.append(choice.message.model_dump(exclude_none=True))
+        for tool_call in choice.message.tool_calls:
+            query = ProductSearchQuery.model_validate_json(tool_call.function.arguments)
+            result = await product_search(config['product_catalog'], query.query, cache=cache)
+            messages.append({"role": "tool", "tool_call_id": tool_call.id, "content": result.answer})
+
+        # The final pass may not search again, which also keeps its stream plain text
+        if config.get('stream_reply', False):
+            async def texts():
+                text = ""
+                async for chunk in await client.chat.completions.create(
+                        model=MODEL, messages=messages, tools=[PRODUCT_SEARCH_TOOL], tool_choice="none", stream=True):
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        text += chunk.choices[0].delta.content
+                        yield text
+
+            return await stream_to_chat(update, context, texts())
+
+        completion = await client.chat.completions.create(
+            model=MODEL, messages=messages, tools=[PRODUCT_SEARCH_TOOL], tool_choice="none")
+        return completion.choices[0].message.content or ""
+    except Exception as e:
+        logger.exception("Error generating reply with tools: {}", e)
+        raise e
+
+
+async def product_search(
+        product_catalog: str,
+        query: str,
+        cache: Optional[Database] = None
+) -> ProductSearchResult:
     logger.info("Performing product search with query: {}", query)
     try:
-        result = await istr_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "user", "content": "Be a helpful assistant with the query"},
+        result = await create_completion(
+            [
                 {"role": "system", "content": product_catalog},
+                {"role": "system", "content": "Be a helpful assistant with the query"},
                 {"role": "user", "content": query}],
-            response_model=ProductSearchResult
+            ProductSearchResult,
+            cache=cache
         )
-        logger.debug(f"Product search result: {result}")
+        logger.debug("Product search result: {}", result)
         return result
     except Exception as e:
-        logger.exception(f"Error in product search: {str(e)}, {format_exc()}")
+        logger.exception("Error in product search: {}", e)
         raise e
 
 
+def prefilter_reply(text: str, config: Dict) -> Optional[str]:
+    """
+    Return a templated reply for greetings, acknowledgements and bare symbols, or None if the model is needed.
+
+    Bots can override templates with a "quick_replies" mapping; "/start" uses "welcome_message" if set.
+    """
+    text = text.strip().lower()
+    if text.startswith('/'):
+        # "/start@my_bot" in groups and "/start <payload>" deep links are still /start
+        text = text.split(maxsplit=1)[0].partition('@')[0]
+    if TRIVIAL_MESSAGE_PATTERN.match(text):
+        key = text
+    elif SHORT_SYMBOLS_PATTERN.match(text):
+        key = 'symbols'
+    else:
+        return None
+
+    quick_replies = {**DEFAULT_QUICK_REPLIES, **config.get('quick_replies', {})}
+    if key == '/start' and config.get('welcome_message'):
+        template = config['welcome_message']
+    else:
+        template = quick_replies[key]
+    prefilter_hits[key] += 1
+    logger.info("Prefilter served {!r} ({} times so far)", key, prefilter_hits[key])
+    return template.replace('{name}', config.get('name', ''))
+
+
+async def act_and_search(
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+        prompt: PromptTemplate | str,
+        chat_history_str: str,
+        config: Dict,
+        cache: Optional[Database] = None
+) -> str:
+    """Classify with act(), run a product search if requested, then generate the reply with a second act()."""
+    speculative_search = None
+    try:
+        # For prompts that almost always search, run the search on the raw message during classification
+        if config.get('speculative_product_search', False):
+            speculative_search = asyncio.create_task(
+                product_search(config['product_catalog'], update.message.text, cache=cache))
+
+        action = await act(prompt, chat_history_str, cache=cache)
+
+        if action.action == 'product_search':
+            logger.info("Initiating product search flow")
+            if speculative_search is not None:
+                product_search_result = await speculative_search
+            else:
+                product_search_result = await product_search(
+                    config['product_catalog'], action.action_input.query, cache=cache)
+            if config.get('stream_reply', False):
+                return await stream_act(update, context, prompt, chat_history_str, product_search_result)
+            action = await act(prompt, chat_history_str, product_search_result, ReplyAction, cache=cache)
+            logger.debug("Generated reply after product search")
+
+        if action.action != 'reply':
+            logger.warning("Expected a reply action, got {}; asking again for a reply", action.action)
+            action = await act(prompt, chat_history_str, action_type=ReplyAction, cache=cache)
+        return action.action_input.message
+    finally:
+        if speculative_search is not None:
+            if speculative_search.done():
+                speculative_search.exception()  # Mark a failed but unused search as retrieved
+            else:
+                speculative_search.cancel()
+
+
 async def reply(
         update: Update,
         context: ContextTypes.DEFAULT_TYPE,
         chat_histories: List[Dict],
         config: Dict,
+        bot_id: Optional[str] = None,
+        db: Optional[Database] = None,
+        prompt: Optional[PromptTemplate] = None,
 ) -> str:
     if update.message and update.message.text:
         logger.info("Processing message: {}",
                     update.message.text[:100] + "..." if len(update.message.text) > 100 else update.message.text)
 
-        chat_histories_str = get_chat_history_as_str(config['name'], chat_histories, update.message.text)
-        logger.debug("Chat history: {}", chat_histories_str)
-        prompt = config.get('prompt', 'Be a helpful assistant with the query, {chat_history}')
+        if config.get('prefilter', False):
+            quick_reply = prefilter_reply(update.message.text, config)
+            if quick_reply is not None:
+                return quick_reply
 
-        try:
-            action = await act(prompt, chat_histories_str)
-
-            if action.action == 'product_search':
-                logger.info("Initiating product search flow")
-                product_search_result = await product_search(config['product_catalog'], action.action_input.query)
-                action = await act(prompt, chat_histories_str, product_search_result, ReplyAction)
-                logger.debug("Generated reply after product search")
+        if prompt is None:
+            prompt = PromptTemplate(config.get('prompt', DEFAULT_PROMPT))
+        # Opt-in: the history in the prompt carries timestamps, so only repeated first messages ever hit
+        cache = db if config.get('llm_cache', False) else None
+        chat_id = str(update.effective_chat.id)
+        use_semantic_cache = (bot_id is not None and config.get('semantic_cache', False)
+                              and semantic_cache.is_cacheable(update.message.text))
 
-            assert action.action == 'reply'
-            return action.action_input.message
+        try:
+            summary = None
+            if db is not None and bot_id is not None and config.get('summarize_history', False):
+                summary = await get_chat_summary(db, chat_id, bot_id, config)
+
+            history_args = (config['name'], chat_histories, update.message.text,
+                            config.get('max_turns', DEFAULT_MAX_TURNS), summary)
+            if use_semantic_cache:
+                # Build the history string while the message is embedded for the semantic cache
+                chat_histories_str, embedding = await asyncio.gather(
+                    asyncio.to_thread(get_chat_history_as_str, *history_args),
+                    semantic_cache.embed(update.message.text))
+                cached_reply = semantic_cache.lookup(
+                    bot_id, chat_id, embedding, config.get('semantic_cache_threshold', DEFAULT_SIMILARITY_THRESHOLD))
+                if cached_reply is not None:
+                    logger.info("Serving reply from semantic cache")
+                    return cached_reply
+            else:
+                # Joining a few rows is cheaper than a thread pool round trip
+                chat_histories_str, embedding = get_chat_history_as_str(*history_args), None
+            logger.opt(lazy=True).debug("Chat history: {}", lambda: chat_histories_str)
+
+            if config.get('tool_calling', False):
+                message = await act_with_tools(update, context, prompt, chat_histories_str, config, cache)
+            else:
+                message = await act_and_search(update, context, prompt, chat_histories_str, config, cache)
+
+            if embedding is not None:
+                semantic_cache.add(bot_id, chat_id, embedding, str(message))
+            return message
 
         except Exception as e:
-            logger.exception(f"Error processing reply: {str(e)}, {format_exc()}")
+            logger.exception("Error processing reply: {}", e)
             return "Sorry, I encountered an error while processing your message."
 
     logger.warning("Received non-text message")
@@ -165,21 +658,23 @@ async def echo_reply(
 
 class ReplyFunctionFactory:
     @staticmethod
-    def create_reply_function(config: Dict, bot_id: str) -> Callable:
+    def create_reply_function(config: Dict, bot_id: str, db: Optional[Database] = None) -> Callable:
         """
         Creates a reply function based on the provided configuration and bot_id.
         
         Args:
             config: Dictionary containing bot configuration
             bot_id: Unique identifier for the bot
+            db: Optional database used to cache LLM responses
             
         Returns:
             Callable that takes Update, Context, and chat histories and returns a response string
         """
         logger.info("Creating reply function for bot {} with config: {}", bot_id, config)
+        prompt = PromptTemplate(config.get('prompt', DEFAULT_PROMPT))
 
         async def reply_fn(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_histories: List[Dict]) -> str:
-            return await reply(update, context, chat_histories, config)
+            return await reply(update, context, chat_histories, config, bot_id, db, prompt)
 
         return reply_fn
 
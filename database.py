@@ -1,17 +1,63 @@
-import json
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+
+# Seconds the bot list stays cached; writes through this class invalidate it immediately
+BOT_LIST_TTL = 5.0
+MMAP_SIZE = 256 * 1024 * 1024
+# Hours an LLM response stays in llm_cache; older rows are ignored and deleted on the next write
+LLM_CACHE_TTL_HOURS = 24
+
+
+@dataclass(slots=True, frozen=True)
+class BotRow:
+    """A row of the bots table, with its config parsed."""
+    bot_id: str
+    token: str
+    bot_handle: str
+    config: Dict
+    status: str
 
 
 class Database:
     def __init__(self, db_file: str = "tg_bots.db"):
         self.db_file = db_file
+        # A single autocommit connection shared by all threads, serialized by a lock that
+        # transaction() holds across several method calls
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        # Parsed bot configs by bot_id and the last bot list; returned as-is, so callers must not mutate them
+        self._config_cache: Dict[str, Dict] = {}
+        self._config_pretty_cache: Dict[str, str] = {}
+        self._bots_cache: Optional[Tuple[float, List[BotRow]]] = None
         self._init_db()
 
+    @contextmanager
+    def transaction(self):
+        """
+        Run several calls of this class in a single transaction, committed (or rolled back) on exit.
+
+        Only methods that do not open a transaction themselves (add_chat, add_message, the getters)
+        may be called inside.
+        """
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            yield self
+
     def _init_db(self):
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+            # Read pages through a memory map instead of read() calls, up to this many bytes of the file
+            cursor.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
 
             # Create bots table
             cursor.execute('''
@@ -50,111 +96,164 @@ class Database:
                 )
             ''')
 
-            conn.commit()
+            # Create chat summaries table, one rolling summary per chat
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chat_summaries (
+                    chat_id TEXT,
+                    bot_id TEXT,
+                    summary TEXT NOT NULL,
+                    last_message_id INTEGER NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (chat_id, bot_id),
+                    FOREIGN KEY (chat_id, bot_id) REFERENCES chats(chat_id, bot_id)
+                )
+            ''')
+
+            # Index history lookups by chat and per-bot deletes
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_chat_bot_ts ON messages(chat_id, bot_id, timestamp)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_bot ON messages(bot_id)")
+            # Seek a chat's messages after a given id, e.g. those not covered by its summary yet
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_messages_chat_bot_id ON messages(chat_id, bot_id, message_id)")
+
+            # Create LLM response cache table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    response_json TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache(created_at)")
+
+    def _row_to_bot(self, row: Tuple) -> BotRow:
+        config = self._config_cache.get(row[0])
+        if config is None:
+            config = self._config_cache[row[0]] = orjson.loads(row[3])
+        return BotRow(row[0], row[1], row[2], config, row[4])
+
+    def _invalidate_bot(self, bot_id: str):
+        self._config_cache.pop(bot_id, None)
+        self._config_pretty_cache.pop(bot_id, None)
+        self._bots_cache = None
+
+    def get_bot_config_pretty(self, bot_id: str) -> Optional[str]:
+        """
+        Indented JSON of a bot's config, rendered once until the bot is updated.
+
+        Rendered from the parsed config cache, read from the database only when the bot is not cached.
+        """
+        with self._lock:
+            pretty = self._config_pretty_cache.get(bot_id)
+            if pretty is None:
+                config = self._config_cache.get(bot_id)
+                if config is None:
+                    bot = self.get_bot(bot_id)
+                    if bot is None:
+                        return None
+                    config = bot.config
+                pretty = self._config_pretty_cache[bot_id] = orjson.dumps(config, option=orjson.OPT_INDENT_2).decode()
+            return pretty
 
     def add_bot(self, bot_id: str, token: str, bot_handle: str, config: Dict) -> bool:
         try:
-            with sqlite3.connect(self.db_file) as conn:
-                cursor = conn.cursor()
+            with self._lock:
+                cursor = self._conn.cursor()
                 cursor.execute(
                     "INSERT INTO bots (bot_id, token, bot_handle, config) VALUES (?, ?, ?, ?)",
-                    (bot_id, token, bot_handle, json.dumps(config))
+                    (bot_id, token, bot_handle, orjson.dumps(config).decode())
                 )
-                conn.commit()
+                self._invalidate_bot(bot_id)
                 return True
         except sqlite3.IntegrityError:
             return False
 
     def update_bot(self, bot_id: str, config: Dict) -> bool:
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
+        with self._lock:
+            cursor = self._conn.cursor()
             cursor.execute(
                 "UPDATE bots SET config = ? WHERE bot_id = ?",
-                (json.dumps(config), bot_id)
+                (orjson.dumps(config).decode(), bot_id)
             )
+            self._invalidate_bot(bot_id)
             return cursor.rowcount > 0
 
     def update_bot_status(self, bot_id: str, status: str) -> bool:
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
+        with self._lock:
+            cursor = self._conn.cursor()
             cursor.execute(
                 "UPDATE bots SET status = ? WHERE bot_id = ?",
                 (status, bot_id)
             )
+            self._bots_cache = None
             return cursor.rowcount > 0
 
     def delete_bot(self, bot_id: str) -> bool:
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
-            # Delete all related messages and chats first
+        with self._lock, self._conn:
+            cursor = self._conn.cursor()
+            cursor.execute("BEGIN")
+            # Delete all related summaries, messages and chats first
+            cursor.execute("DELETE FROM chat_summaries WHERE bot_id = ?", (bot_id,))
             cursor.execute("DELETE FROM messages WHERE bot_id = ?", (bot_id,))
             cursor.execute("DELETE FROM chats WHERE bot_id = ?", (bot_id,))
             cursor.execute("DELETE FROM bots WHERE bot_id = ?", (bot_id,))
+            self._invalidate_bot(bot_id)
             return cursor.rowcount > 0
 
-    def get_bot(self, bot_id: str) -> Optional[Dict]:
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
+    def get_bot(self, bot_id: str) -> Optional[BotRow]:
+        with self._lock:
+            cursor = self._conn.cursor()
             cursor.execute(
                 "SELECT bot_id, token, bot_handle, config, status FROM bots WHERE bot_id = ?",
                 (bot_id,)
             )
             row = cursor.fetchone()
             if row:
-                return {
-                    "bot_id": row[0],
-                    "token": row[1],
-                    "bot_handle": row[2],
-                    "config": json.loads(row[3]),
-                    "status": row[4]
-                }
+                return self._row_to_bot(row)
             return None
 
-    def get_bot_by_handle(self, bot_handle: str) -> Optional[Dict]:
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
+    def get_bot_by_handle(self, bot_handle: str) -> Optional[BotRow]:
+        with self._lock:
+            cursor = self._conn.cursor()
             cursor.execute(
                 "SELECT bot_id, token, bot_handle, config, status FROM bots WHERE bot_handle = ?",
                 (bot_handle,)
             )
             row = cursor.fetchone()
             if row:
-                return {
-                    "bot_id": row[0],
-                    "token": row[1],
-                    "bot_handle": row[2],
-                    "config": json.loads(row[3]),
-                    "status": row[4]
-                }
+                return self._row_to_bot(row)
             return None
 
-    def get_all_bots(self) -> List[Dict]:
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
+    def get_all_bots(self) -> List[BotRow]:
+        with self._lock:
+            if self._bots_cache and time.monotonic() - self._bots_cache[0] < BOT_LIST_TTL:
+                return list(self._bots_cache[1])
+            cursor = self._conn.cursor()
             cursor.execute("SELECT bot_id, token, bot_handle, config, status FROM bots")
-            return [{
-                "bot_id": row[0],
-                "token": row[1],
-                "bot_handle": row[2],
-                "config": json.loads(row[3]),
-                "status": row[4]
-            } for row in cursor.fetchall()]
+            bots = [self._row_to_bot(row) for row in cursor.fetchall()]
+            self._bots_cache = (time.monotonic(), bots)
+            return list(bots)
+
+    def get_bot_handles(self) -> List[str]:
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute("SELECT bot_handle FROM bots")
+            return [row[0] for row in cursor.fetchall()]
 
     def add_chat(self, chat_id: str, bot_id: str, chat_name: str) -> bool:
-        try:
-            with sqlite3.connect(self.db_file) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT INTO chats (chat_id, bot_id, chat_name) VALUES (?, ?, ?)",
-                    (chat_id, bot_id, chat_name)
-                )
-                return True
-        except sqlite3.IntegrityError:
-            return False
+        """Add a chat if it does not exist yet; returns whether it was added."""
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO chats (chat_id, bot_id, chat_name) VALUES (?, ?, ?)",
+                (chat_id, bot_id, chat_name)
+            )
+            return cursor.rowcount > 0
 
     def get_chats(self, bot_id: str) -> List[Dict]:
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
+        with self._lock:
+            cursor = self._conn.cursor()
             cursor.execute(
                 "SELECT chat_id, chat_name FROM chats WHERE bot_id = ?",
                 (bot_id,)
@@ -166,8 +265,8 @@ class Database:
 
     def add_message(self, chat_id: str, bot_id: str, message_text: str, is_from_bot: bool) -> bool:
         try:
-            with sqlite3.connect(self.db_file) as conn:
-                cursor = conn.cursor()
+            with self._lock:
+                cursor = self._conn.cursor()
                 cursor.execute(
                     "INSERT INTO messages (chat_id, bot_id, message_text, is_from_bot) VALUES (?, ?, ?, ?)",
                     (chat_id, bot_id, message_text, is_from_bot)
@@ -176,15 +275,46 @@ class Database:
         except sqlite3.IntegrityError:
             return False
 
-    def get_chat_history(self, chat_id: str, bot_id: str) -> List[Dict]:
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
+    def add_messages_bulk(
+            self,
+            rows: List[Tuple[str, str, str, bool]],
+            chats: List[Tuple[str, str, str]] = ()
+    ) -> bool:
+        """
+        Insert (chat_id, bot_id, message_text, is_from_bot) rows in a single transaction, after adding the
+        (chat_id, bot_id, chat_name) chats that do not exist yet.
+        """
+        try:
+            with self.transaction():
+                cursor = self._conn.cursor()
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO chats (chat_id, bot_id, chat_name) VALUES (?, ?, ?)",
+                    chats
+                )
+                cursor.executemany(
+                    "INSERT INTO messages (chat_id, bot_id, message_text, is_from_bot) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+                return cursor.rowcount > 0
+        except sqlite3.IntegrityError:
+            return False
+
+    def get_chat_history(self, chat_id: str, bot_id: str, limit: Optional[int] = 50, offset: int = 0) -> List[Dict]:
+        """
+        Get the most recent `limit` messages of a chat in chronological order, or all if limit is None,
+        skipping the `offset` newest ones.
+        """
+        with self._lock:
+            cursor = self._conn.cursor()
             cursor.execute(
-                """SELECT message_text, is_from_bot, timestamp 
-                FROM messages 
-                WHERE chat_id = ? AND bot_id = ?
-                ORDER BY timestamp""",
-                (chat_id, bot_id)
+                """SELECT message_text, is_from_bot, timestamp FROM (
+                    SELECT message_id, message_text, is_from_bot, timestamp
+                    FROM messages 
+                    WHERE chat_id = ? AND bot_id = ?
+                    ORDER BY timestamp DESC, message_id DESC
+                    LIMIT ? OFFSET ?)
+                ORDER BY timestamp, message_id""",
+                (chat_id, bot_id, -1 if limit is None else limit, offset)
             )
             return [{
                 "message": row[0],
@@ -192,12 +322,122 @@ class Database:
                 "timestamp": row[2]
             } for row in cursor.fetchall()]
 
+    def get_chat_summary(self, chat_id: str, bot_id: str) -> Optional[Dict]:
+        """Get the rolling summary of a chat and the id of the last message it covers."""
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute(
+                "SELECT summary, last_message_id FROM chat_summaries WHERE chat_id = ? AND bot_id = ?",
+                (chat_id, bot_id)
+            )
+            row = cursor.fetchone()
+            if row:
+                return {
+                    "summary": row[0],
+                    "last_message_id": row[1]
+                }
+            return None
+
+    def set_chat_summary(self, chat_id: str, bot_id: str, summary: str, last_message_id: int) -> bool:
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute(
+                """INSERT OR REPLACE INTO chat_summaries (chat_id, bot_id, summary, last_message_id)
+                VALUES (?, ?, ?, ?)""",
+                (chat_id, bot_id, summary, last_message_id)
+            )
+            return cursor.rowcount > 0
+
+    def count_messages_after(self, chat_id: str, bot_id: str, message_id: int = 0, limit: Optional[int] = None) -> int:
+        """Count a chat's messages newer than `message_id`, stopping at `limit` if given."""
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute(
+                """SELECT COUNT(*) FROM (
+                    SELECT 1 FROM messages WHERE chat_id = ? AND bot_id = ? AND message_id > ? LIMIT ?)""",
+                (chat_id, bot_id, message_id, -1 if limit is None else limit)
+            )
+            return cursor.fetchone()[0]
+
+    def get_chat_summary_backlog(self, chat_id: str, bot_id: str, limit: int) -> Tuple[Optional[Dict], int]:
+        """Get the rolling summary of a chat and how many messages it does not cover yet, counting at most `limit`."""
+        with self._lock:
+            chat_summary = self.get_chat_summary(chat_id, bot_id)
+            last_message_id = chat_summary["last_message_id"] if chat_summary else 0
+            return chat_summary, self.count_messages_after(chat_id, bot_id, last_message_id, limit)
+
+    def get_messages_to_summarize(
+            self,
+            chat_id: str,
+            bot_id: str,
+            after_message_id: int,
+            keep_recent: int,
+            limit: int
+    ) -> List[Dict]:
+        """
+        Get the oldest `limit` messages newer than `after_message_id`, except the `keep_recent` most recent ones.
+        """
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute(
+                """SELECT message_id, message_text, is_from_bot, timestamp
+                FROM messages
+                WHERE chat_id = ? AND bot_id = ? AND message_id > ? AND message_id <= (
+                    SELECT message_id FROM messages
+                    WHERE chat_id = ? AND bot_id = ?
+                    ORDER BY message_id DESC
+                    LIMIT 1 OFFSET ?)
+                ORDER BY message_id
+                LIMIT ?""",
+                (chat_id, bot_id, after_message_id, chat_id, bot_id, keep_recent, limit)
+            )
+            return [{
+                "message_id": row[0],
+                "message": row[1],
+                "is_from_bot": bool(row[2]),
+                "timestamp": row[3]
+            } for row in cursor.fetchall()]
+
     def clear_chat_history(self, chat_id: str, bot_id: str) -> bool:
         """Clear all messages for a specific chat."""
-        with sqlite3.connect(self.db_file) as conn:
-            cursor = conn.cursor()
+        with self._lock, self._conn:
+            cursor = self._conn.cursor()
+            cursor.execute("BEGIN")
+            cursor.execute(
+                "DELETE FROM chat_summaries WHERE chat_id = ? AND bot_id = ?",
+                (chat_id, bot_id)
+            )
             cursor.execute(
                 "DELETE FROM messages WHERE chat_id = ? AND bot_id = ?",
                 (chat_id, bot_id)
             )
             return cursor.rowcount > 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get_llm_cache(self, key: str) -> Optional[str]:
+        """Return the cached LLM response JSON for a request key, if any and not expired."""
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute(
+                "SELECT response_json FROM llm_cache WHERE key = ? AND created_at > datetime('now', ?)",
+                (key, f"-{LLM_CACHE_TTL_HOURS} hours")
+            )
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def set_llm_cache(self, key: str, response_json: str) -> bool:
+        """Store an LLM response JSON under a request key, deleting the expired responses."""
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute(
+                "DELETE FROM llm_cache WHERE created_at <= datetime('now', ?)",
+                (f"-{LLM_CACHE_TTL_HOURS} hours",)
+            )
+            cursor.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response_json) VALUES (?, ?)",
+                (key, response_json)
+            )
+            return cursor.rowcount > 0
@@ -0,0 +1,129 @@
+import asyncio
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+DEFAULT_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+DEFAULT_SIMILARITY_THRESHOLD = 0.92
+FAISS_INDEX_THRESHOLD = 10_000
+# Chats whose entries are kept; the least recently active are evicted
+MAX_CHATS = 1_000
+# Entries a chat's embedding matrix holds at first; it doubles when full
+INITIAL_CAPACITY = 8
+# Shorter messages, e.g. "yes" or "what's my order?", mean different things depending on the conversation
+MIN_MESSAGE_LENGTH = 20
+
+
+class _ChatCache:
+    """Normalized embeddings and replies of a single chat."""
+
+    def __init__(self, dim: int, capacity: int = INITIAL_CAPACITY):
+        self.matrix = np.empty((capacity, dim), dtype=np.float32)
+        self.size = 0
+        self.responses: List[str] = []
+        self.index: Optional[Any] = None  # faiss.IndexFlatIP once the chat has many entries
+
+    def add(self, embedding: np.ndarray, response: str):
+        self.responses.append(response)
+        if self.index is not None:
+            self.index.add(embedding.reshape(1, -1))
+            return
+
+        if self.size == len(self.matrix):
+            self.matrix = np.concatenate([self.matrix, np.empty_like(self.matrix)])
+        self.matrix[self.size] = embedding
+        self.size += 1
+
+        if self.size > FAISS_INDEX_THRESHOLD:
+            import faiss
+
+            logger.info("Moving semantic cache with {} entries to a FAISS index", self.size)
+            self.index = faiss.IndexFlatIP(self.matrix.shape[1])
+            self.index.add(self.matrix[:self.size])
+            self.matrix = None
+
+    def best_match(self, embedding: np.ndarray) -> Tuple[float, int]:
+        if self.index is not None:
+            sims, ids = self.index.search(embedding.reshape(1, -1), 1)
+            return float(sims[0, 0]), int(ids[0, 0])
+        sims = self.matrix[:self.size] @ embedding
+        best = int(sims.argmax())
+        return float(sims[best]), best
+
+
+class SemanticCache:
+    """
+    Reuse replies for near-duplicate user messages.
+
+    Messages are embedded with a small local sentence-transformers model and compared by cosine
+    similarity against earlier messages of the same chat, so a reply is never served to another user.
+    Only the `max_chats` most recently active chats keep their entries.
+    sentence-transformers (and faiss, for large chats) are only imported once a bot uses the cache.
+    """
+
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME, max_chats: int = MAX_CHATS):
+        self.model_name = model_name
+        self.max_chats = max_chats
+        self._model: Optional["SentenceTransformer"] = None
+        # Entries by (bot_id, chat_id), in least recently used order
+        self._chats: OrderedDict[Tuple[str, str], _ChatCache] = OrderedDict()
+
+    @staticmethod
+    def is_cacheable(text: str) -> bool:
+        """Whether a message is long enough to mean the same thing regardless of the conversation."""
+        return len(text.strip()) >= MIN_MESSAGE_LENGTH
+
+    def _encode(self, text: str) -> np.ndarray:
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+
+            logger.info("Loading semantic cache embedding model {}", self.model_name)
+            self._model = SentenceTransformer(self.model_name)
+        return self._model.encode(text, normalize_embeddings=True).astype(np.float32)
+
+    async def embed(self, text: str) -> np.ndarray:
+        """Embed a message off the event loop."""
+        return await asyncio.to_thread(self._encode, text)
+
+    def lookup(
+            self,
+            bot_id: str,
+            chat_id: str,
+            embedding: np.ndarray,
+            threshold: float = DEFAULT_SIMILARITY_THRESHOLD
+    ) -> Optional[str]:
+        """Return a cached reply in the same chat whose message is similar enough, if any."""
+        key = (bot_id, chat_id)
+        chat_cache = self._chats.get(key)
+        if not chat_cache or not chat_cache.responses:
+            return None
+        self._chats.move_to_end(key)
+        similarity, idx = chat_cache.best_match(embedding)
+        if similarity > threshold:
+            logger.debug("Semantic cache hit for bot {}, chat {} with similarity {:.3f}", bot_id, chat_id, similarity)
+            return chat_cache.responses[idx]
+        return None
+
+    def add(self, bot_id: str, chat_id: str, embedding: np.ndarray, response: str):
+        key = (bot_id, chat_id)
+        chat_cache = self._chats.get(key)
+        if chat_cache is None:
+            chat_cache = self._chats[key] = _ChatCache(embedding.shape[0])
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(key)
+        chat_cache.add(embedding, response)
+
+    def drop(self, bot_id: str, chat_id: Optional[str] = None):
+        """Forget the entries of a chat, or of all chats of the bot when chat_id is None."""
+        if chat_id is not None:
+            self._chats.pop((bot_id, chat_id), None)
+            return
+        for key in [key for key in self._chats if key[0] == bot_id]:
+            del self._chats[key]
@@ -1,145 +1,171 @@
-import asyncio
-import json
+import contextlib
+import hmac
 import threading
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional
 
 import gradio as gr
+import orjson
+import uvicorn
+from fastapi import FastAPI, Request, Response
 
-from database import Database
-from tg_module import TelegramBotManager, default_config_json
+from database import BotRow, Database
+from tg_module import WEBHOOK_PATH, TelegramBotManager, default_config_json
+
+BOT_LIST_SEP = "-" * 50
+# Most recent messages of a chat shown in the history tab
+HISTORY_PAGE_SIZE = 200
 
 
 class TelegramBotServiceGradio:
-    def __init__(self):
+    def __init__(self, public_url: Optional[str] = None):
         self.db = Database()
-        self.bot_manager = TelegramBotManager(self.db)
-
-        # Start asyncio event loop in a separate thread
-        self.loop = asyncio.new_event_loop()
-        self.thread = threading.Thread(target=self._run_event_loop, daemon=True)
-        self.thread.start()
-
-    def _run_event_loop(self):
-        asyncio.set_event_loop(self.loop)
-        self.loop.run_forever()
+        self.bot_manager = TelegramBotManager(self.db, webhook_base_url=public_url)
+        self._handles_cache: Optional[List[str]] = None
+        self._handle_to_id: Dict[str, str] = {}
+        self._handles_lock = threading.Lock()
+
+    def _invalidate_handles(self):
+        with self._handles_lock:
+            self._handles_cache = None
+
+    def _remember(self, bot_handle: str, bot: Optional[BotRow]) -> Optional[str]:
+        if bot is None:
+            return None
+        # A single dict write needs no lock, see _resolve
+        self._handle_to_id[bot_handle] = bot.bot_id
+        return bot.bot_id
+
+    def _resolve(self, bot_handle: str) -> Optional[str]:
+        """Map a bot handle to its bot ID, looking it up in the database only once."""
+        # A single dict read needs no lock, so a hit never waits for list_bot_handles' query
+        bot_id = self._handle_to_id.get(bot_handle)
+        if bot_id is None:
+            bot_id = self._remember(bot_handle, self.db.get_bot_by_handle(bot_handle))
+        return bot_id
+
+    async def _resolve_async(self, bot_handle: str) -> Optional[str]:
+        """Like _resolve, for handlers on the event loop; a miss is looked up on the database thread pool."""
+        bot_id = self._handle_to_id.get(bot_handle)
+        if bot_id is None:
+            bot_id = self._remember(bot_handle, await self.bot_manager.get_bot_by_handle(bot_handle))
+        return bot_id
 
     def create_bot(self, token: str, bot_handle: str, config_str: str) -> str:
         """Create a new bot with the given token and configuration."""
         try:
-            config = json.loads(config_str)
-        except json.JSONDecodeError:
+            config = orjson.loads(config_str)
+        except orjson.JSONDecodeError:
             return "错误：JSON配置格式无效"
 
         bot_id = self.bot_manager.create_bot(token, bot_handle, config)
+        self._invalidate_handles()
         if bot_id:
+            with self._handles_lock:
+                self._handle_to_id[bot_handle] = bot_id
             return f"成功：机器人已创建，ID为：{bot_id}"
         return "错误：创建机器人失败"
 
-    def list_bots(self) -> List[Dict]:
+    async def list_bots(self) -> List[BotRow]:
         """Get a list of all bots and their status."""
-        return self.bot_manager.list_bots()
+        return await self.bot_manager.list_bots()
 
     def list_bot_handles(self) -> List[str]:
-        """Get a list of all bot handles."""
-        return [b['bot_handle'] for b in self.bot_manager.list_bots()]
+        """Get a list of all bot handles, cached until a bot is created, updated or deleted."""
+        with self._handles_lock:
+            if self._handles_cache is None:
+                self._handles_cache = self.bot_manager.list_bot_handles()
+            return list(self._handles_cache)
 
     def get_bot_config(self, bot_handle: str) -> str:
         """Get the configuration of a bot."""
-        # get_bot_by_handle
-        bot = self.bot_manager.get_bot_by_handle(bot_handle)
-        return json.dumps(bot['config'], indent=4, ensure_ascii=False)
+        return self.db.get_bot_config_pretty(self._resolve(bot_handle))
 
     def get_bot_info(self, bot_handle: str) -> str:
         """Get the status of a bot."""
-        bot = self.bot_manager.get_bot_by_handle(bot_handle)
-        result = [f"机器人ID：{bot['bot_id']}",
-                  f"用户名：{bot['bot_handle']}",
-                  f"状态：{bot['status']}"]
+        bot = self.bot_manager.get_bot(self._resolve(bot_handle))
+        result = [f"机器人ID：{bot.bot_id}",
+                  f"用户名：{bot.bot_handle}",
+                  f"状态：{bot.status}"]
         return "\n".join(result)
 
-    def format_bot_list(self) -> str:
+    async def format_bot_list(self) -> str:
         """Format bot list for display."""
-        bots = self.list_bots()
+        bots = await self.list_bots()
         if not bots:
             return "未找到机器人"
 
-        result = []
-        for bot in bots:
-            result.append(f"机器人ID：{bot['bot_id']}")
-            result.append(f"用户名：{bot['bot_handle']}")
-            result.append(f"状态：{bot['status']}")
-            result.append(f"配置：{json.dumps(bot['config'], indent=2, ensure_ascii=False)}")
-            result.append("-" * 50)
-        return "\n".join(result)
+        return "\n".join(
+            f"机器人ID：{bot.bot_id}\n"
+            f"用户名：{bot.bot_handle}\n"
+            f"状态：{bot.status}\n"
+            f"配置：{self.db.get_bot_config_pretty(bot.bot_id)}\n"
+            f"{BOT_LIST_SEP}"
+            for bot in bots
+        )
 
     async def start_bot(self, bot_handle: str) -> str:
         """Start a bot."""
-        bot = self.bot_manager.get_bot_by_handle(bot_handle)
-        if await self.bot_manager.start_bot(bot['bot_id']):
+        bot_id = await self._resolve_async(bot_handle)
+        if await self.bot_manager.start_bot(bot_id):
             return f"成功：机器人 {bot_handle} 已启动"
         return f"错误：启动机器人 {bot_handle} 失败"
 
     async def stop_bot(self, bot_handle: str) -> str:
         """Stop a bot."""
-        bot = self.bot_manager.get_bot_by_handle(bot_handle)
-        if await self.bot_manager.stop_bot(bot['bot_id']):
+        bot_id = await self._resolve_async(bot_handle)
+        if await self.bot_manager.stop_bot(bot_id):
             return f"成功：机器人 {bot_handle} 已停止"
         return f"错误：停止机器人 {bot_handle} 失败"
 
     async def delete_bot(self, bot_handle: str) -> str:
         """Delete a bot."""
-        bot = self.bot_manager.get_bot_by_handle(bot_handle)
-        if await self.bot_manager.delete_bot(bot['bot_id']):
+        deleted = await self.bot_manager.delete_bot(await self._resolve_async(bot_handle))
+        self._invalidate_handles()
+        if deleted:
+            with self._handles_lock:
+                self._handle_to_id.pop(bot_handle, None)
             return f"成功：机器人 {bot_handle} 已删除"
         return f"错误：删除机器人 {bot_handle} 失败"
 
     def update_bot_config(self, bot_handle: str, config_str: str) -> str:
         """Update bot configuration."""
-        bot = self.bot_manager.get_bot_by_handle(bot_handle)
+        bot_id = self._resolve(bot_handle)
         try:
-            config = json.loads(config_str)
-        except json.JSONDecodeError:
+            config = orjson.loads(config_str)
+        except orjson.JSONDecodeError:
             return "错误：JSON配置格式无效"
 
-        if self.bot_manager.update_bot(bot['bot_id'], config):
+        updated = self.bot_manager.update_bot(bot_id, config)
+        self._invalidate_handles()
+        if updated:
             return f"成功：机器人 {bot_handle} 配置已更新"
         return f"错误：更新机器人配置失败"
 
-    def list_chats(self, bot_handle: str) -> List[str]:
+    async def list_chats(self, bot_handle: str) -> List[str]:
         """List all chats for a bot."""
-        bot = self.bot_manager.get_bot_by_handle(bot_handle)
-        chats = self.bot_manager.list_chats(bot['bot_id'])
+        bot_id = await self._resolve_async(bot_handle)
+        chats = await self.bot_manager.list_chats(bot_id)
         if not chats:
             return []
 
-        result = []
-        for chat in chats:
-            chat_id = chat['chat_id']
-            chat_name = chat['chat_name']
-            result.append(f'聊天名称：{chat_name} <{chat_id}>')
-        return result
-
-    def get_chat_history(self, bot_handle: str, chat_info: str) -> str:
-        """Get chat history."""
-        bot = self.bot_manager.get_bot_by_handle(bot_handle)
-        chat_id = chat_info.split("<")[1].split(">")[0]
-        history = self.bot_manager.get_chat_history(bot['bot_id'], chat_id)
-        if not history:
-            return "未找到消息记录"
-
-        result = []
-        for msg in history:
-            sender = "机器人" if msg['is_from_bot'] else "用户"
-            result.append(f"{sender}：{msg['message']}")
-            result.append(f"时间：{msg['timestamp']}")
-            result.append("-" * 30)
-        return "\n".join(result)
+        return [f"聊天名称：{chat['chat_name']} <{chat['chat_id']}>" for chat in chats]
 
-    def clear_chat_history(self, bot_handle: str, chat_info: str) -> str:
+    async def get_chat_history(self, bot_handle: str, chat_info: str) -> List[Dict]:
+        """Get the most recent chat history as role/content messages for gr.Chatbot."""
+        bot_id = await self._resolve_async(bot_handle)
+        chat_id = chat_info.rpartition("<")[2].partition(">")[0]
+        history = await self.bot_manager.get_chat_history(bot_id, chat_id, limit=HISTORY_PAGE_SIZE)
+        return [
+            {"role": "assistant" if msg['is_from_bot'] else "user",
+             "content": f"{msg['message']}\n\n时间：{msg['timestamp']}"}
+            for msg in history
+        ]
+
+    async def clear_chat_history(self, bot_handle: str, chat_info: str) -> str:
         """Clear chat history."""
-        bot = self.bot_manager.get_bot_by_handle(bot_handle)
-        chat_id = chat_info.split("<")[1].split(">")[0]
-        if self.bot_manager.clear_chat_history(bot['bot_id'], chat_id):
+        bot_id = await self._resolve_async(bot_handle)
+        chat_id = chat_info.rpartition("<")[2].partition(">")[0]
+        if await self.bot_manager.clear_chat_history(bot_id, chat_id):
             return "成功：聊天记录已清除"
         return "提示：没有找到可清除的消息"
 
@@ -187,23 +213,16 @@ class TelegramBotServiceGradio:
                 (bot_select
                  .select(fn=self.get_bot_info, inputs=bot_select, outputs=bot_info)
                  .then(fn=self.get_bot_config, inputs=bot_select, outputs=bot_config))
+                # Bot lifecycle handlers are coroutines, so Gradio runs them on its own event loop,
+                # which also hosts the running bots
                 (start_btn
-                 .click(fn=lambda x: asyncio.run_coroutine_threadsafe(
-                    self.start_bot(x), self.loop).result(),
-                        inputs=bot_select, outputs=action_output)
+                 .click(fn=self.start_bot, inputs=bot_select, outputs=action_output)
                  .then(fn=self.get_bot_info, inputs=bot_select, outputs=bot_info))
                 (stop_btn
-                 .click(
-                    fn=lambda x: asyncio.run_coroutine_threadsafe(
-                        self.stop_bot(x), self.loop).result(),
-                    inputs=bot_select, outputs=action_output)
+                 .click(fn=self.stop_bot, inputs=bot_select, outputs=action_output)
                  .then(fn=self.get_bot_info, inputs=bot_select, outputs=bot_info))
                 (delete_btn
-                 .click(
-                    fn=lambda x: asyncio.run_coroutine_threadsafe(
-                        self.delete_bot(x), self.loop).result(),
-                    inputs=bot_select,
-                    outputs=action_output)
+                 .click(fn=self.delete_bot, inputs=bot_select, outputs=action_output)
                  .then(lambda: '', None, bot_info)
                  .then(lambda: '', None, bot_config)
                  .then(lambda: gr.Dropdown(choices=self.list_bot_handles()), None, bot_select))
@@ -218,12 +237,16 @@ class TelegramBotServiceGradio:
                     chat_bot_select = gr.Dropdown(label="机器人列表", choices=[], interactive=True)
                     chat_select = gr.Dropdown(label="聊天列表", choices=[], interactive=True)
 
-                history_output = gr.Textbox(label="聊天历史", lines=10, show_copy_button=True)
+                history_output = gr.Chatbot(label=f"聊天历史（最近{HISTORY_PAGE_SIZE}条）",
+                                            placeholder="未找到消息记录", show_copy_button=True, type="messages")
                 clear_history_btn = gr.Button("清除聊天记录", variant="secondary")
                 chat_action_output = gr.Textbox(label="操作结果")
 
+                async def refresh_chats(bot_handle: str) -> gr.Dropdown:
+                    return gr.Dropdown(choices=await self.list_chats(bot_handle))
+
                 chat_bot_select.focus(lambda: gr.Dropdown(choices=self.list_bot_handles()), None, chat_bot_select)
-                chat_bot_select.select(fn=lambda x: gr.Dropdown(choices=self.list_chats(x)),
+                chat_bot_select.select(fn=refresh_chats,
                                        inputs=chat_bot_select,
                                        outputs=chat_select)
                 chat_select.select(fn=self.get_chat_history,
@@ -234,8 +257,8 @@ class TelegramBotServiceGradio:
                     fn=self.clear_chat_history,
                     inputs=[chat_bot_select, chat_select],
                     outputs=chat_action_output)
-                 .then(lambda: '', None, history_output)
-                 .then(fn=lambda x: gr.Dropdown(choices=self.list_chats(x)),
+                 .then(lambda: [], None, history_output)
+                 .then(fn=refresh_chats,
                        inputs=chat_bot_select,
                        outputs=chat_select))
 
@@ -250,11 +273,30 @@ class TelegramBotServiceGradio:
         """
         interface = self.create_ui()
         interface.queue()
-        interface.launch(
-            server_name=server_name,
-            server_port=server_port,
-            # share=server_name == "0.0.0.0"  # Enable sharing if binding to all interfaces
-        )
+
+        @contextlib.asynccontextmanager
+        async def lifespan(_app: FastAPI):
+            # Bring back the bots that were running when the service last stopped
+            await self.bot_manager.start_all()
+            yield
+            await self.bot_manager.close()
+
+        app = FastAPI(lifespan=lifespan)
+
+        if self.bot_manager.webhook_base_url:
+            # With a public URL, Telegram pushes updates to a webhook served next to the interface
+            @app.post(WEBHOOK_PATH + "/{bot_id}")
+            async def telegram_webhook(bot_id: str, request: Request) -> Response:
+                secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+                if not hmac.compare_digest(secret, self.bot_manager.webhook_secret):
+                    return Response(status_code=403)
+                if await self.bot_manager.process_webhook_update(bot_id, orjson.loads(await request.body())):
+                    return Response()
+                return Response(status_code=404)
+
+        app = gr.mount_gradio_app(app, interface, path="/")
+        # loop="auto" runs the bots, the webhook and the interface on uvloop where it is installed
+        uvicorn.run(app, host=server_name or "127.0.0.1", port=server_port, loop="auto")
 
 
 if __name__ == "__main__":
@@ -263,8 +305,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="运行Telegram机器人管理系统")
     parser.add_argument("--host", default=None, help="服务器主机名或IP (例如: '0.0.0.0'表示公开访问)")
     parser.add_argument("--port", type=int, default=7860, help="服务器端口号")
+    parser.add_argument("--public-url", default=None,
+                        help="本服务的公网HTTPS地址 (例如: 'https://bots.example.com')，设置后机器人使用Webhook接收消息")
 
     args = parser.parse_args()
 
-    service = TelegramBotServiceGradio()
+    service = TelegramBotServiceGradio(public_url=args.public_url)
     service.run(server_name=args.host, server_port=args.port)
@@ -1,14 +1,21 @@
-import json
-import uuid
-from typing import Dict, List, Optional
-
+import asyncio
+import functools
+import secrets
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import orjson
 from loguru import logger
 from telegram import Update
 from telegram.ext import (Application, CommandHandler, ContextTypes,
                           MessageHandler, filters)
+from telegram.request import HTTPXRequest
 
-from chat_module import ReplyFunctionFactory
-from database import Database
+from chat_module import ReplyFunctionFactory, StreamedReply, semantic_cache
+from database import BotRow, Database
 
 default_config = {
     "name": "Required, e.g. John Doe",
@@ -16,15 +23,161 @@ default_config = {
     "prompt": "Required, must contain {chat_history} {product_search_result}, e.g. Be a helpful assistant and provide useful information. \n{chat_history} \n{product_search_result}",
     "product_catalog": "Required, e.g. Product catalog: \n- Product 1: $100 \n- Product 2: $200 \n- Product 3: $300",
 }
-default_config_json = json.dumps(default_config, indent=2, ensure_ascii=False)
+default_config_json = orjson.dumps(default_config, option=orjson.OPT_INDENT_2).decode()
+# Number of recent messages per chat kept in memory for the prompt, unless set by `history_window`
+DEFAULT_HISTORY_WINDOW = 50
+# Chats whose history is kept in memory across all bots; the least recently active are evicted
+HISTORY_CACHE_CHATS = 10_000
+# Path under the public URL that Telegram posts a bot's updates to, followed by /<bot_id>
+WEBHOOK_PATH = "/telegram"
+# Port of a bot's own webhook server when `webhook_url` is set but `webhook_port` is not
+DEFAULT_WEBHOOK_PORT = 8443
+# Seconds Telegram holds a getUpdates request open while there are no updates
+POLL_TIMEOUT = 50
+# Plain text messages, handled by every bot's message handler
+TEXT_NOT_CMD = filters.TEXT & ~filters.COMMAND
+# Updates of one bot handled at the same time; further updates wait in the application's update queue
+HANDLER_CONCURRENCY = 32
+
+
+def history_row(message_text: str, is_from_bot: bool) -> Dict:
+    """A chat history row as returned by Database.get_chat_history, timestamped like SQLite's CURRENT_TIMESTAMP."""
+    return {
+        "message": message_text,
+        "is_from_bot": is_from_bot,
+        "timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+
+class SharedHTTPXRequest(HTTPXRequest):
+    """An HTTPXRequest shared by several bots, whose connections outlive each bot's shutdown."""
+
+    async def shutdown(self) -> None:
+        # Called by every Application.shutdown(); the pool stays open for the other and restarted bots
+        pass
+
+    async def close(self) -> None:
+        """Close the pool once no bot uses it any more."""
+        await super().shutdown()
+
+
+class MessageBuffer:
+    """
+    Queue chat and message inserts for a background task that writes them in one transaction per batch,
+    `flush_interval` seconds after the first queued row or as soon as `max_batch` rows are queued.
+    """
+
+    def __init__(
+            self,
+            database: Database,
+            executor: Optional[Executor] = None,
+            max_batch: int = 200,
+            flush_interval: float = 0.5
+    ):
+        self.db = database
+        self.executor = executor
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._batch: List[Tuple] = []
+        self._full = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+        self._pending: Counter = Counter()  # Queued messages by (chat_id, bot_id)
+        self._flusher: Optional[asyncio.Task] = None
+
+    def add_chat(self, chat_id: str, bot_id: str, chat_name: str):
+        self._put(("chat", chat_id, bot_id, chat_name))
+
+    def add(self, chat_id: str, bot_id: str, message_text: str, is_from_bot: bool):
+        self._pending[(chat_id, bot_id)] += 1
+        self._put(("message", chat_id, bot_id, message_text, is_from_bot))
+
+    def _put(self, item: Tuple):
+        self._queue.put_nowait(item)
+        if self._queue.qsize() + len(self._batch) >= self.max_batch:
+            self._full.set()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run())
+
+    def has_pending(self, chat_id: str, bot_id: str) -> bool:
+        return self._pending[(chat_id, bot_id)] > 0
+
+    async def _run(self):
+        while True:
+            self._batch.append(await self._queue.get())
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        """Write everything queued so far right away, after the batch being written if any."""
+        async with self._write_lock:
+            self._full.clear()
+            while not self._queue.empty():
+                self._batch.append(self._queue.get_nowait())
+            if not self._batch:
+                return
+            batch, self._batch = self._batch, []
+            chats = [item[1:] for item in batch if item[0] == "chat"]
+            messages = [item[1:] for item in batch if item[0] == "message"]
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.db.add_messages_bulk, messages, chats)
+                logger.debug("Flushed {} buffered chats and {} messages", len(chats), len(messages))
+            except Exception as e:
+                logger.exception("Error flushing {} buffered chats and {} messages: {}",
+                                 len(chats), len(messages), e)
+            finally:
+                self._pending -= Counter((row[0], row[1]) for row in messages)
+
+    async def close(self):
+        """Write everything queued so far and stop the background task."""
+        await self.flush()
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
 
 
 class TelegramBotManager:
-    def __init__(self, database: Database):
+    __slots__ = ("db", "webhook_base_url", "webhook_secret", "running_bots", "_db_executor", "message_buffer",
+                 "request", "history_cache", "_known_chats", "_bot_locks", "_webhook_ports")
+
+    def __init__(self, database: Database, webhook_base_url: Optional[str] = None):
         self.db = database
+        # Public base URL Telegram pushes updates to (see process_webhook_update); bots poll when not set
+        self.webhook_base_url = webhook_base_url.rstrip("/") if webhook_base_url else None
+        self.webhook_secret = secrets.token_urlsafe(32)
         self.running_bots: Dict[str, Application] = {}
+        # Blocking SQLite calls run here rather than on the event loop shared by all bots
+        self._db_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db")
+        self.message_buffer = MessageBuffer(database, self._db_executor)
+        # Bot API requests of all bots share one HTTP/2 connection pool, kept across restarts
+        self.request = SharedHTTPXRequest(connection_pool_size=256, pool_timeout=30, http_version="2")
+        # Recent messages by (bot_id, chat_id), seeded from the database on a chat's first message,
+        # in least recently used order
+        self.history_cache: OrderedDict[Tuple[str, str], Deque[Dict]] = OrderedDict()
+        # Chats already queued for insertion by bot_id, so add_chat runs once per chat while a bot runs
+        self._known_chats: Dict[str, Set[str]] = {}
+        # Serializes start, stop and delete of the same bot, e.g. double clicks in the UI
+        self._bot_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # Local ports of the running bots that serve their own webhook (see webhook_url), by bot_id
+        self._webhook_ports: Dict[str, int] = {}
         logger.info("TelegramBotManager initialized")
 
+    async def _db(self, fn: Callable, *args) -> Any:
+        """Run a blocking Database call on the database thread pool."""
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, fn, *args)
+
+    def _drop_history_cache(self, bot_id: str):
+        for key in [key for key in self.history_cache if key[0] == bot_id]:
+            del self.history_cache[key]
+
     def create_bot(self, token: str, bot_handle: str, config: Dict) -> Optional[str]:
         """
         Create a new bot with the given token and configuration.
@@ -37,7 +190,7 @@ class TelegramBotManager:
         Returns:
             bot_id if successful, None otherwise
         """
-        bot_id = str(uuid.uuid4())
+        bot_id = secrets.token_hex(16)
         logger.info(f"Creating new bot with ID: {bot_id}, handle: {bot_handle}")
         if self.db.add_bot(bot_id, token, bot_handle, config):
             logger.success(f"Bot {bot_id} ({bot_handle}) created successfully")
@@ -78,16 +231,79 @@ class TelegramBotManager:
             True if successful, False otherwise
         """
         logger.info(f"Attempting to delete bot {bot_id}")
-        if bot_id in self.running_bots:
-            logger.info(f"Stopping bot {bot_id} before deletion")
-            await self.stop_bot(bot_id)
-        success = self.db.delete_bot(bot_id)
+        async with self._bot_locks[bot_id]:
+            if bot_id in self.running_bots:
+                logger.info(f"Stopping bot {bot_id} before deletion")
+                await self._stop_bot(bot_id)
+            success = await self._db(self.db.delete_bot, bot_id)
+            self._drop_history_cache(bot_id)
+            semantic_cache.drop(bot_id)
+            self._known_chats.pop(bot_id, None)
         if success:
+            # The bot is gone, so its lock is not needed any more; later calls for the ID get a fresh one
+            self._bot_locks.pop(bot_id, None)
             logger.success(f"Bot {bot_id} deleted successfully")
         else:
             logger.error(f"Failed to delete bot {bot_id}")
         return success
 
+    async def _on_message(
+            self,
+            bot_id: str,
+            reply_func: Callable,
+            history_window: int,
+            known_chats: Set[str],
+            update: Update,
+            context: ContextTypes.DEFAULT_TYPE
+    ):
+        """Handle a message (or /start, /help with the prefilter) sent to a running bot; bound in start_bot."""
+        history_cache = self.history_cache
+        message_buffer = self.message_buffer
+
+        # Nothing to answer, e.g. an edited message; return before any cache or database work
+        message = update.message
+        if not message or not message.text:
+            return
+        text = message.text
+        chat = message.chat
+        chat_id = str(chat.id)
+
+        logger.debug("Processing message from chat {}", chat_id)
+
+        history_key = (bot_id, chat_id)
+        history = history_cache.get(history_key)
+        if history is not None:
+            history_cache.move_to_end(history_key)
+        else:
+            # Write this chat's queued messages before seeding the history from the database
+            if message_buffer.has_pending(chat_id, bot_id):
+                await message_buffer.flush()
+            rows = await self._db(self.db.get_chat_history, chat_id, bot_id, history_window)
+            # Another message of the chat may have seeded it meanwhile
+            history = history_cache.setdefault(history_key, deque(rows, maxlen=history_window))
+            if len(history_cache) > HISTORY_CACHE_CHATS:
+                history_cache.popitem(last=False)
+
+        # Ensure chat exists and record the incoming message, both written by the buffer's flusher
+        if chat_id not in known_chats:
+            known_chats.add(chat_id)
+            message_buffer.add_chat(chat_id, bot_id, chat.title or chat.first_name or chat_id)
+        chat_history = list(history)
+        logger.debug("Recording incoming message from chat {}", chat_id)
+        message_buffer.add(chat_id, bot_id, text, False)
+        history.append(history_row(text, False))
+
+        # Generate reply
+        reply = await reply_func(update, context, chat_history)
+
+        # Record and send reply, unless it was already streamed to the chat
+        if reply:
+            logger.debug("Sending reply to chat {}", chat_id)
+            message_buffer.add(chat_id, bot_id, reply, True)
+            history.append(history_row(reply, True))
+            if not isinstance(reply, StreamedReply):
+                await message.reply_text(reply)
+
     async def start_bot(self, bot_id: str) -> bool:
         """
         Start running a bot.
@@ -98,68 +314,92 @@ class TelegramBotManager:
         Returns:
             True if successful, False otherwise
         """
+        async with self._bot_locks[bot_id]:
+            return await self._start_bot(bot_id)
+
+    async def _start_bot(self, bot_id: str) -> bool:
         logger.info(f"Starting bot {bot_id}")
 
         if bot_id in self.running_bots:
             logger.warning(f"Bot {bot_id} is already running")
             return False
 
-        bot_data = self.db.get_bot(bot_id)
+        bot_data = await self._db(self.db.get_bot, bot_id)
         if not bot_data:
             logger.error(f"Bot {bot_id} not found in database")
             return False
 
+        webhook_url = bot_data.config.get("webhook_url")
+        webhook_port = bot_data.config.get("webhook_port", DEFAULT_WEBHOOK_PORT)
+        if webhook_url:
+            other_bot_id = next((other for other, port in self._webhook_ports.items() if port == webhook_port), None)
+            if other_bot_id:
+                logger.error(f"Cannot start bot {bot_id}: webhook port {webhook_port} is already used by bot "
+                             f"{other_bot_id}, set a different webhook_port")
+                return False
+            # Reserve the port before the first await, so bots started concurrently by start_all see it
+            self._webhook_ports[bot_id] = webhook_port
+
+        application = None
         try:
-            application = Application.builder().token(bot_data["token"]).build()
-            reply_func = ReplyFunctionFactory.create_reply_function(bot_data["config"], bot_id)
+            # Let PTB run a bounded number of handlers concurrently, over the shared connection pool. Only a
+            # polling bot gets its own pool for the long-held getUpdates requests, closed by application.shutdown()
+            polling = not webhook_url and not self.webhook_base_url
+            application = (Application.builder()
+                           .token(bot_data.token)
+                           .concurrent_updates(HANDLER_CONCURRENCY)
+                           .request(self.request)
+                           .get_updates_request(HTTPXRequest(connection_pool_size=8) if polling else self.request)
+                           .build())
+            reply_func = ReplyFunctionFactory.create_reply_function(bot_data.config, bot_id, self.db)
+            history_window = bot_data.config.get("history_window", DEFAULT_HISTORY_WINDOW)
             logger.debug(f"Created application and reply function for bot {bot_id}")
 
-            async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-                if not update.effective_chat:
-                    logger.warning("Received update without effective chat")
-                    return
-
-                chat_id = str(update.effective_chat.id)
-                chat_name = update.effective_chat.title or update.effective_chat.first_name or str(chat_id)
-
-                logger.debug(f"Processing message from chat {chat_id} ({chat_name})")
-
-                # Ensure chat exists in database
-                self.db.add_chat(chat_id, bot_id, chat_name)
-
-                # Get chat history
-                chat_history = self.db.get_chat_history(chat_id, bot_id)
-
-                # Record incoming message
-                if update.message and update.message.text:
-                    logger.debug(f"Recording incoming message from chat {chat_id}")
-                    self.db.add_message(chat_id, bot_id, update.message.text, False)
-
-                # Generate reply
-                reply = await reply_func(update, context, chat_history)
-
-                # Record and send reply
-                if reply:
-                    logger.debug(f"Sending reply to chat {chat_id}")
-                    self.db.add_message(chat_id, bot_id, reply, True)
-                    await update.message.reply_text(reply)
+            message_handler = functools.partial(
+                self._on_message, bot_id, reply_func, history_window, self._known_chats.setdefault(bot_id, set()))
 
             # Add handlers
-            application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+            if bot_data.config.get("prefilter", False):
+                # /start and /help are answered from templates; without the prefilter commands are not answered
+                application.add_handler(CommandHandler(["start", "help"], message_handler))
+            application.add_handler(MessageHandler(TEXT_NOT_CMD, message_handler))
             logger.debug(f"Added message handler for bot {bot_id}")
 
             # Start the bot
             await application.initialize()
             await application.start()
-            await application.updater.start_polling()
+            if webhook_url:
+                # The bot serves its own webhook, e.g. when it has a public host of its own; Telegram posts to
+                # the path of webhook_url, so listen on that path
+                await application.updater.start_webhook(
+                    listen="0.0.0.0", port=webhook_port, url_path=urlparse(webhook_url).path,
+                    webhook_url=webhook_url, secret_token=self.webhook_secret)
+            elif self.webhook_base_url:
+                await application.bot.set_webhook(
+                    f"{self.webhook_base_url}{WEBHOOK_PATH}/{bot_id}", secret_token=self.webhook_secret)
+            else:
+                # Long polling: each getUpdates is held open by Telegram until an update arrives
+                await application.updater.start_polling(timeout=POLL_TIMEOUT, poll_interval=0)
 
             self.running_bots[bot_id] = application
-            self.db.update_bot_status(bot_id, "running")
+            await self._db(self.db.update_bot_status, bot_id, "running")
             logger.success(f"Bot {bot_id} started successfully")
             return True
 
         except Exception as e:
             logger.exception(f"Error starting bot {bot_id}: {str(e)}")
+            self._webhook_ports.pop(bot_id, None)
+            self.running_bots.pop(bot_id, None)
+            if application is not None:
+                # Release what a half-started bot holds, e.g. when its webhook port turned out to be taken
+                try:
+                    if application.updater.running:
+                        await application.updater.stop()
+                    if application.running:
+                        await application.stop()
+                    await application.shutdown()
+                except Exception as shutdown_error:
+                    logger.exception(f"Error shutting down bot {bot_id} after failed start: {str(shutdown_error)}")
             return False
 
     async def stop_bot(self, bot_id: str) -> bool:
@@ -172,6 +412,10 @@ class TelegramBotManager:
         Returns:
             True if successful, False otherwise
         """
+        async with self._bot_locks[bot_id]:
+            return await self._stop_bot(bot_id)
+
+    async def _stop_bot(self, bot_id: str, status: Optional[str] = "stopped") -> bool:
         logger.info(f"Stopping bot {bot_id}")
 
         if bot_id not in self.running_bots:
@@ -180,12 +424,22 @@ class TelegramBotManager:
 
         try:
             application = self.running_bots[bot_id]
-            await application.updater.stop()
+            if application.updater.running:
+                await application.updater.stop()
+            else:
+                await application.bot.delete_webhook()
             await application.stop()
-            await application.shutdown()
-
             del self.running_bots[bot_id]
-            self.db.update_bot_status(bot_id, "stopped")
+            self._webhook_ports.pop(bot_id, None)
+
+            # Once no handler runs any more, closing the bot's connections and the database writes are independent
+            await asyncio.gather(
+                application.shutdown(),
+                self.message_buffer.flush(),
+                *([self._db(self.db.update_bot_status, bot_id, status)] if status else [])
+            )
+            self._drop_history_cache(bot_id)
+            self._known_chats.pop(bot_id, None)
             logger.success(f"Bot {bot_id} stopped successfully")
             return True
 
@@ -193,7 +447,52 @@ class TelegramBotManager:
             logger.exception(f"Error stopping bot {bot_id}: {str(e)}")
             return False
 
-    def get_bot(self, bot_id: str) -> Optional[Dict]:
+    async def start_all(self) -> int:
+        """
+        Start all bots marked as running in the database concurrently, e.g. after a restart of the service.
+
+        Returns:
+            Number of bots started
+        """
+        bots = await self._db(self.db.get_all_bots)
+        results = await asyncio.gather(*[self.start_bot(bot.bot_id) for bot in bots if bot.status == "running"])
+        logger.info(f"Started {sum(results)} of {len(results)} bots marked as running")
+        return sum(results)
+
+    async def close(self):
+        """
+        Stop all running bots and release the shared connection pool and database threads, e.g. when the
+        service shuts down. The bots stay marked as running, so start_all brings them back on the next start.
+        """
+        async def stop(bot_id: str) -> bool:
+            async with self._bot_locks[bot_id]:
+                return await self._stop_bot(bot_id, status=None)
+
+        await asyncio.gather(*[stop(bot_id) for bot_id in list(self.running_bots)])
+        await self.message_buffer.close()
+        await self.request.close()
+        self._db_executor.shutdown()
+        self.db.close()
+        logger.info("TelegramBotManager closed")
+
+    async def process_webhook_update(self, bot_id: str, data: Dict) -> bool:
+        """
+        Queue an update that Telegram posted to a bot's webhook.
+
+        Args:
+            bot_id: Unique identifier for the bot
+            data: Decoded JSON body of the webhook request
+
+        Returns:
+            True if the bot is running and the update was queued, False otherwise
+        """
+        application = self.running_bots.get(bot_id)
+        if application is None:
+            return False
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return True
+
+    def get_bot(self, bot_id: str) -> Optional[BotRow]:
         """
         Get bot information by bot_id.
 
@@ -201,12 +500,12 @@ class TelegramBotManager:
             bot_id: Unique identifier for the bot
 
         Returns:
-            Dictionary containing bot information
+            BotRow with the bot information, or None if not found
         """
         logger.debug(f"Retrieving bot information for bot {bot_id}")
         return self.db.get_bot(bot_id)
 
-    def get_bot_by_handle(self, bot_handle: str) -> Optional[Dict]:
+    async def get_bot_by_handle(self, bot_handle: str) -> Optional[BotRow]:
         """
         Get bot information by bot handle.
 
@@ -214,22 +513,32 @@ class TelegramBotManager:
             bot_handle: Telegram bot handle (username)
 
         Returns:
-            Dictionary containing bot information
+            BotRow with the bot information, or None if not found
         """
         logger.debug(f"Retrieving bot information for bot handle {bot_handle}")
-        return self.db.get_bot_by_handle(bot_handle)
+        return await self._db(self.db.get_bot_by_handle, bot_handle)
 
-    def list_bots(self) -> List[Dict]:
+    async def list_bots(self) -> List[BotRow]:
         """
         Get a list of all bots and their status.
         
         Returns:
-            List of dictionaries containing bot information
+            List of BotRow with the bot information
         """
         logger.debug("Retrieving list of all bots")
-        return self.db.get_all_bots()
+        return await self._db(self.db.get_all_bots)
+
+    def list_bot_handles(self) -> List[str]:
+        """
+        Get the handles of all bots.
+
+        Returns:
+            List of bot handles
+        """
+        logger.debug("Retrieving list of all bot handles")
+        return self.db.get_bot_handles()
 
-    def list_chats(self, bot_id: str) -> List[Dict]:
+    async def list_chats(self, bot_id: str) -> List[Dict]:
         """
         Get a list of all chats for a specific bot.
         
@@ -240,23 +549,25 @@ class TelegramBotManager:
             List of dictionaries containing chat information
         """
         logger.debug(f"Retrieving chat list for bot {bot_id}")
-        return self.db.get_chats(bot_id)
+        return await self._db(self.db.get_chats, bot_id)
 
-    def get_chat_history(self, bot_id: str, chat_id: str) -> List[Dict]:
+    async def get_chat_history(self, bot_id: str, chat_id: str, limit: Optional[int] = 200, offset: int = 0) -> List[Dict]:
         """
         Get the chat history for a specific chat.
         
         Args:
             bot_id: Unique identifier for the bot
             chat_id: Unique identifier for the chat
+            limit: Maximum number of most recent messages to return, or None for all
+            offset: Number of most recent messages to skip
             
         Returns:
             List of dictionaries containing message information
         """
         logger.debug(f"Retrieving chat history for bot {bot_id}, chat {chat_id}")
-        return self.db.get_chat_history(chat_id, bot_id)
+        return await self._db(self.db.get_chat_history, chat_id, bot_id, limit, offset)
 
-    def clear_chat_history(self, bot_id: str, chat_id: str) -> bool:
+    async def clear_chat_history(self, bot_id: str, chat_id: str) -> bool:
         """
         Clear chat history for a specific chat.
         
@@ -268,7 +579,10 @@ class TelegramBotManager:
             True if successful and messages were deleted, False otherwise
         """
         logger.info(f"Clearing chat history for bot {bot_id}, chat {chat_id}")
-        success = self.db.clear_chat_history(chat_id, bot_id)
+        await self.message_buffer.flush()
+        success = await self._db(self.db.clear_chat_history, chat_id, bot_id)
+        self.history_cache.pop((bot_id, chat_id), None)
+        semantic_cache.drop(bot_id, chat_id)
         if success:
             logger.success(f"Chat history cleared for bot {bot_id}, chat {chat_id}")
         else: